@@ -1,39 +1,106 @@
 import asyncio
 import html
-import json
-from typing import Any, Dict, Tuple
+import logging
+from typing import AsyncIterator, Dict, Tuple
 
-from aiohttp import ClientTimeout
+from aiohttp import ClientSession, ClientTimeout, StreamReader, TCPConnector
 from maubot import MessageEvent, Plugin
 from maubot.handlers import command
-from mautrix.types import (EventType, Format, MessageType,
+from mautrix.types import (JSON, EventType, Format, MessageType, RoomID,
                            TextMessageEventContent)
 from mautrix.util.async_db import UpgradeTable
 from mautrix.util.config import BaseProxyConfig
-from mautrix.util.formatter import parse_html
+from mautrix.util.logging import TRACE
+from yarl import URL
 
 from .config import Config
-from .db import DB, Topic, upgrade_table
+from .db import DB, Subscription, Topic, upgrade_table
 from .emoji import EMOJI_FALLBACK, WHITE_CHECK_MARK, parse_tags
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# matches "server/topic", capturing server and topic separately
+# see https://github.com/binwiederhier/ntfy/blob/82df434d19e3ef45ada9c00dfe9fc0f8dfba15e6/server/server.go#L61 for the valid topic regex
+TOPIC_REGEX = r"((?:[a-zA-Z0-9-]{1,63}\.)+[a-zA-Z]{2,6})/([a-zA-Z0-9_-]{1,64})"
+READ_CHUNK_SIZE = 64 * 1024
+# longest accepted line, so a server that never sends a newline can't exhaust memory
+MAX_LINE_SIZE = 1024 * 1024
+# upper bound of concurrent matrix sends, to avoid flooding the homeserver
+MAX_CONCURRENT_SENDS = 32
+# how often received event IDs are persisted, in seconds
+EVENT_ID_FLUSH_INTERVAL = 2.0
+
+
+async def iter_lines(stream: StreamReader) -> AsyncIterator[bytearray]:
+    # split the lines ourselves, StreamReader.readline() fails with
+    # "Line is too long" once a line exceeds its buffer limit
+    buf = bytearray()
+    while True:
+        chunk = await stream.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        # the buffered partial line has already been searched for newlines
+        search = len(buf)
+        buf += chunk
+        start = 0
+        while (end := buf.find(b"\n", search)) != -1:
+            yield buf[start:end]
+            start = search = end + 1
+        del buf[:start]
+        if len(buf) > MAX_LINE_SIZE:
+            raise ValueError("Line exceeds %d bytes" % MAX_LINE_SIZE)
+    if buf:
+        yield buf
+
 
 class NtfyBot(Plugin):
     db: DB
     config: Config
-    tasks: Dict[int, asyncio.Task] = {}
+    tasks: Dict[int, asyncio.Task]
+    topics: Dict[int, Topic]
+    pending_event_ids: Dict[int, str]
+    flush_task: asyncio.Task
+    ntfy_session: ClientSession
+    send_semaphore: asyncio.Semaphore
 
     async def start(self) -> None:
         await super().start()
         self.config.load_and_update()
         self.db = DB(self.database, self.log)
+        self.tasks = {}
+        self.topics = {}
+        self.pending_event_ids = {}
+        self.send_semaphore = asyncio.Semaphore(MAX_CONCURRENT_SENDS)
         if EMOJI_FALLBACK:
             self.log.warn(
                 "Please install the `emoji` package for full emoji support")
-        await self.resubscribe()
+        # dedicated session for the long-lived ntfy streams, so DNS results
+        # and connections are reused when resubscribing
+        self.ntfy_session = ClientSession(
+            headers=self.http.headers,
+            connector=TCPConnector(limit=0, ttl_dns_cache=300, keepalive_timeout=75))
+        self.flush_task = self.loop.create_task(self.flush_event_ids_loop())
+        try:
+            await self.resubscribe()
+        except Exception:
+            await self.clear_subscriptions()
+            self.flush_task.cancel()
+            await self.ntfy_session.close()
+            raise
 
     async def stop(self) -> None:
         await super().stop()
         await self.clear_subscriptions()
+        await self.ntfy_session.close()
+        self.flush_task.cancel()
+        try:
+            await self.flush_task
+        except asyncio.CancelledError:
+            pass
+        await self.flush_event_ids()
 
     async def on_external_config_update(self) -> None:
         self.log.info("Refreshing configuration")
@@ -60,6 +127,27 @@ class NtfyBot(Plugin):
                 self.log.exception("Subscription task errored", exc_info=exc)
         self.tasks.clear()
 
+    async def flush_event_ids(self) -> None:
+        for topic_id in list(self.pending_event_ids):
+            # re-read the entry, it may have been dropped while flushing,
+            # e.g. by unsubscribe clearing the topic
+            event_id = self.pending_event_ids.get(topic_id)
+            if event_id is None:
+                continue
+            await self.db.update_topic_id(topic_id, event_id)
+            # only drop the entry once it is written and wasn't replaced meanwhile
+            if self.pending_event_ids.get(topic_id) == event_id:
+                del self.pending_event_ids[topic_id]
+
+    async def flush_event_ids_loop(self) -> None:
+        while True:
+            await asyncio.sleep(EVENT_ID_FLUSH_INTERVAL)
+            try:
+                await self.flush_event_ids()
+            except Exception as exc:
+                self.log.exception(
+                    "Failed to persist last event IDs", exc_info=exc)
+
     async def can_use_command(self, evt: MessageEvent) -> bool:
         if evt.sender in self.config["admins"]:
             return True
@@ -75,57 +163,67 @@ class NtfyBot(Plugin):
         pass
 
     @ntfy.subcommand("subscribe", aliases=("sub",), help="Subscribe this room to a ntfy topic.")
-    @command.argument("topic", "topic URL", matches="(([a-zA-Z0-9-]{1,63}\\.)+[a-zA-Z]{2,6}/[a-zA-Z0-9_-]{1,64})")
-    async def subscribe(self, evt: MessageEvent, topic: Tuple[str, Any]) -> None:
-        # see https://github.com/binwiederhier/ntfy/blob/82df434d19e3ef45ada9c00dfe9fc0f8dfba15e6/server/server.go#L61 for the valid topic regex
+    @command.argument("topic", "topic URL", matches=TOPIC_REGEX)
+    async def subscribe(self, evt: MessageEvent, topic: Tuple[str, str]) -> None:
         if not await self.can_use_command(evt):
             return None
-        server, topic = topic[0].split("/")
-        db_topic = await self.db.get_topic(server, topic)
-        if not db_topic:
-            db_topic = await self.db.create_topic(Topic(id=-1, server=server, topic=topic, last_event_id=None))
-        existing_subscriptions = await self.db.get_subscriptions(db_topic.id)
-        sub, _ = await self.db.get_subscription(db_topic.id, evt.room_id)
-        if sub:
+        server, topic = topic
+        db_topic = await self.db.upsert_topic(server, topic)
+        if not await self.db.try_add_subscription(db_topic.id, evt.room_id):
             await evt.reply("This room is already subscribed to %s/%s", server, topic)
-        else:
-            await self.db.add_subscription(db_topic.id, evt.room_id)
-            await evt.reply("Subscribed this room to %s/%s", server, topic)
-            await evt.react(WHITE_CHECK_MARK)
-            if not existing_subscriptions:
-                self.subscribe_to_topic(db_topic)
+            return
+        # keep the subscriptions of the running topic task up to date
+        live_topic = self.topics.setdefault(db_topic.id, db_topic)
+        live_topic.subscriptions.append(
+            Subscription(topic_id=db_topic.id, room_id=evt.room_id))
+        await evt.reply("Subscribed this room to %s/%s", server, topic)
+        await evt.react(WHITE_CHECK_MARK)
+        # only the first subscription starts a topic task
+        if live_topic is db_topic:
+            self.subscribe_to_topic(live_topic)
 
     @ntfy.subcommand("unsubscribe", aliases=("unsub",), help="Unsubscribe this room from a ntfy topic.")
-    @command.argument("topic", "topic URL", matches="(([a-zA-Z0-9-]{1,63}\\.)+[a-zA-Z]{2,6}/[a-zA-Z0-9_-]{1,64})")
-    async def unsubscribe(self, evt: MessageEvent, topic: Tuple[str, Any]) -> None:
-        # see https://github.com/binwiederhier/ntfy/blob/82df434d19e3ef45ada9c00dfe9fc0f8dfba15e6/server/server.go#L61 for the valid topic regex
+    @command.argument("topic", "topic URL", matches=TOPIC_REGEX)
+    async def unsubscribe(self, evt: MessageEvent, topic: Tuple[str, str]) -> None:
         if not await self.can_use_command(evt):
             return None
-        server, topic = topic[0].split("/")
+        server, topic = topic
         db_topic = await self.db.get_topic(server, topic)
         if not db_topic:
             await evt.reply("This room is not subscribed to %s/%s", server, topic)
             return
-        sub, _ = await self.db.get_subscription(db_topic.id, evt.room_id)
+        sub = await self.db.get_subscription(db_topic.id, evt.room_id)
         if not sub:
             await evt.reply("This room is not subscribed to %s/%s", server, topic)
             return
         await self.db.remove_subscription(db_topic.id, evt.room_id)
-        if not await self.db.get_subscriptions(db_topic.id):
-            self.tasks[db_topic.id].cancel()
+        live_topic = self.topics.get(db_topic.id)
+        if live_topic:
+            live_topic.subscriptions = [
+                sub for sub in live_topic.subscriptions if sub.room_id != evt.room_id]
+        if not live_topic or not live_topic.subscriptions:
+            self.topics.pop(db_topic.id, None)
+            task = self.tasks.get(db_topic.id)
+            if task:
+                task.cancel()
+            self.pending_event_ids.pop(db_topic.id, None)
             await self.db.clear_topic_id(db_topic.id)
         await evt.reply("Unsubscribed this room from %s/%s", server, topic)
         await evt.react(WHITE_CHECK_MARK)
 
     async def subscribe_to_topics(self) -> None:
         topics = await self.db.get_topics()
+        self.topics = {topic.id: topic for topic in topics}
         for topic in topics:
             self.subscribe_to_topic(topic)
 
     def subscribe_to_topic(self, topic: Topic) -> None:
         def log_task_exc(task: asyncio.Task) -> None:
-            t2 = self.tasks.pop(topic.id, None)
-            if t2 != task:
+            # only untrack the task if it wasn't replaced in the meantime,
+            # otherwise the newer task could no longer be cancelled
+            if self.tasks.get(topic.id) is task:
+                del self.tasks[topic.id]
+            else:
                 self.log.warn("stored task doesn't match callback")
             if task.done() and not task.cancelled():
                 exc = task.exception()
@@ -134,14 +232,15 @@ class NtfyBot(Plugin):
                 self.tasks[topic.id] = self.loop.create_task(
                     asyncio.sleep(10.0))
                 self.tasks[topic.id].add_done_callback(
-                    lambda _: self.subscribe_to_topic(topic))
+                    lambda t: t.cancelled() or self.subscribe_to_topic(topic))
 
         self.log.info("Subscribing to %s/%s", topic.server, topic.topic)
         url = "%s/%s/json" % (topic.server, topic.topic)
         if not url.startswith(("http://", "https://")):
             url = "https://" + url
+        url = URL(url)
         if topic.last_event_id:
-            url += "?since=%s" % topic.last_event_id
+            url = url.with_query(since=topic.last_event_id)
 
         self.log.debug("Subscribing to URL %s", url)
         task = self.loop.create_task(
@@ -149,42 +248,57 @@ class NtfyBot(Plugin):
         self.tasks[topic.id] = task
         task.add_done_callback(log_task_exc)
 
-    async def run_topic_subscription(self, topic: Topic, url: str) -> None:
-        async with self.http.get(url, timeout=ClientTimeout()) as resp:
-            while True:
-                line = await resp.content.readline()
-                # convert to string and remove trailing newline
-                line = line.decode("utf-8").strip()
-                self.log.trace("Received notification: %s", line)
-                message = json.loads(line)
+    async def run_topic_subscription(self, topic: Topic, url: URL) -> None:
+        timeout = ClientTimeout(total=None, sock_read=None)
+        async with self.ntfy_session.get(url, timeout=timeout) as resp:
+            async for line in iter_lines(resp.content):
+                # both orjson and json accept raw bytes(arrays), no need to decode
+                line = line.strip()
+                if not line:
+                    continue
+                # only decode the raw line if it is actually logged
+                if self.log.isEnabledFor(TRACE):
+                    self.log.trace("Received notification: %s",
+                                   line.decode("utf-8", "replace"))
+                message = json_loads(line)
                 if message["event"] != "message":
                     continue
-                self.log.debug("Received message event: %s", line)
-                # persist the received message id
-                await self.db.update_topic_id(topic.id, message["id"])
+                if self.log.isEnabledFor(logging.DEBUG):
+                    self.log.debug("Received message event: %s",
+                                   line.decode("utf-8", "replace"))
+                # remember the received message id, it is persisted
+                # periodically by flush_event_ids_loop
+                topic.last_event_id = message["id"]
+                self.pending_event_ids[topic.id] = message["id"]
 
                 # build matrix message
-                html_content = self.build_message_content(
-                    topic.server, message)
-                text_content = await parse_html(html_content.strip())
+                html_content, text_content = self.build_message_content(
+                    topic, message)
 
+                # serialize once instead of once per subscribed room
                 content = TextMessageEventContent(
                     msgtype=MessageType.TEXT,
                     format=Format.HTML,
                     formatted_body=html_content,
                     body=text_content,
-                )
-
-                subscriptions = await self.db.get_subscriptions(topic.id)
-                for sub in subscriptions:
-                    try:
-                        await self.client.send_message(sub.room_id, content)
-                    except Exception as exc:
-                        self.log.exception(
-                            "Failed to send matrix message!", exc_info=exc)
-
-    def build_message_content(self, server: str, message) -> str:
-        topic = message["topic"]
+                ).serialize()
+
+                await asyncio.gather(
+                    *(self.send_safely(sub.room_id, content)
+                      for sub in topic.subscriptions),
+                    return_exceptions=True)
+        raise EOFError("Subscription stream closed by server")
+
+    async def send_safely(self, room_id: RoomID, content: JSON) -> None:
+        async with self.send_semaphore:
+            try:
+                await self.client.send_message_event(
+                    room_id, EventType.ROOM_MESSAGE, content)
+            except Exception as exc:
+                self.log.exception(
+                    "Failed to send matrix message!", exc_info=exc)
+
+    def build_message_content(self, topic: Topic, message) -> Tuple[str, str]:
         body = message["message"]
         title = message.get("title", None)
         tags = message.get("tags", None)
@@ -192,42 +306,53 @@ class NtfyBot(Plugin):
         attachment = message.get("attachment", None)
 
         if tags:
-            (emoji, non_emoji) = parse_tags(self.log, tags)
+            (emoji, non_emoji) = parse_tags(tags)
             emoji = "".join(emoji) + " "
             tags = ", ".join(non_emoji)
         else:
             emoji = tags = ""
 
-        html_content = "<span>Ntfy message in topic <code>%s/%s</code></span><blockquote>" % (
-            html.escape(server), html.escape(topic))
+        body_html = html.escape(body).replace("\n", "<br />")
+
+        # the plain text body is built alongside the html, which avoids
+        # having to parse the html again
+        parts = [topic.html_prefix]
+        text_parts = ["Ntfy message in topic %s/%s" % (topic.server, topic.topic)]
         # build title
         if title and click:
-            html_content += "<h4>%s<a href=\"%s\">%s</a></h4>" % (
-                emoji, html.escape(click), html.escape(title))
+            parts.append("<h4>%s<a href=\"%s\">%s</a></h4>" % (
+                emoji, html.escape(click), html.escape(title)))
+            text_parts.append("%s%s (%s)" % (emoji, title, click))
             emoji = ""
         elif title:
-            html_content += "<h4>%s%s</h4>" % (emoji, html.escape(title))
+            parts.append("<h4>%s%s</h4>" % (emoji, html.escape(title)))
+            text_parts.append(emoji + title)
             emoji = ""
 
         # build body
         if click and not title:
-            html_content += "%s<a href=\"%s\">%s</a>" % (
-                emoji, html.escape(click), html.escape(body).replace("\n", "<br />"))
+            parts.append("%s<a href=\"%s\">%s</a>" % (
+                emoji, html.escape(click), body_html))
+            text_parts.append("%s%s (%s)" % (emoji, body, click))
         else:
-            html_content += emoji + html.escape(body).replace("\n", "<br />")
+            parts.append(emoji + body_html)
+            text_parts.append(emoji + body)
 
         # add non-emoji tags
         if tags:
-            html_content += "<br/><small>Tags: <code>%s</code></small>" % html.escape(
-                tags)
+            parts.append("<br/><small>Tags: <code>%s</code></small>" % html.escape(
+                tags))
+            text_parts.append("Tags: %s" % tags)
 
         # build attachment
         if attachment:
-            html_content += "<br/><a href=\"%s\">View %s</a>" % (html.escape(
-                attachment["url"]), html.escape(attachment["name"]))
-        html_content += "</blockquote>"
+            parts.append("<br/><a href=\"%s\">View %s</a>" % (html.escape(
+                attachment["url"]), html.escape(attachment["name"])))
+            text_parts.append("View %s: %s" % (
+                attachment["name"], attachment["url"]))
+        parts.append("</blockquote>")
 
-        return html_content
+        return ("".join(parts), "\n".join(part.strip() for part in text_parts))
 
     @classmethod
     def get_config_class(cls) -> type[BaseProxyConfig]:
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
-from typing import List, Tuple
+import html
+from typing import Dict, List
 
 import attr
 from asyncpg import Record
@@ -12,6 +13,9 @@ from mautrix.util.logging import TraceLogger
 upgrade_table = UpgradeTable()
 
 
+# No extra indices are needed: UNIQUE (server, topic) is used for topic lookups,
+# and the (topic_id, room_id) primary key is used for subscription lookups by topic
+# on both postgres and sqlite (where it is backed by an automatic index).
 @upgrade_table.register(description="Initial revision")
 async def upgrade_v1(conn: Connection, scheme: Scheme) -> None:
     gen = "GENERATED ALWAYS AS IDENTITY" if scheme != Scheme.SQLITE else ""
@@ -45,6 +49,15 @@ class Topic:
     last_event_id: str
 
     subscriptions: List[Subscription] = attr.ib(factory=lambda: [])
+    _html_prefix: str | None = attr.ib(default=None, repr=False, eq=False)
+
+    @property
+    def html_prefix(self) -> str:
+        # server and topic never change, so only escape them once
+        if self._html_prefix is None:
+            self._html_prefix = "<span>Ntfy message in topic <code>%s/%s</code></span><blockquote>" % (
+                html.escape(self.server), html.escape(self.topic))
+        return self._html_prefix
 
     @classmethod
     def from_row(cls, row: Record | None) -> Topic | None:
@@ -69,7 +82,7 @@ class Subscription:
     room_id: RoomID
 
     @classmethod
-    def from_row(cls, row: Record | None) -> Topic | None:
+    def from_row(cls, row: Record | None) -> Subscription | None:
         if not row:
             return None
         topic_id = row["topic_id"]
@@ -96,11 +109,10 @@ class DB:
             subscriptions ON topics.id = subscriptions.topic_id
         """
         rows = await self.db.fetch(query)
-        topics = {}
+        topics: Dict[int, Topic] = {}
         for row in rows:
-            try:
-                topic = topics[row["id"]]
-            except KeyError:
+            topic = topics.get(row["id"])
+            if topic is None:
                 topic = topics[row["id"]] = Topic.from_row(row)
             topic.subscriptions.append(Subscription.from_row(row))
         return list(topics.values())
@@ -117,27 +129,23 @@ class DB:
         """
         await self.db.execute(query, topic_id)
 
-    async def create_topic(self, topic: Topic) -> Topic:
+    async def upsert_topic(self, server: str, topic: str) -> Topic:
         query = """
         INSERT INTO topics (server, topic, last_event_id)
-        VALUES ($1, $2, $3) RETURNING (id)
+        VALUES ($1, $2, NULL)
+        ON CONFLICT (server, topic) DO UPDATE SET server=excluded.server
+        RETURNING id, server, topic, last_event_id
         """
         if self.db.scheme == Scheme.SQLITE:
-            cur = await self.db.execute(
-                query.replace("RETURNING (id)", ""),
-                topic.server,
-                topic.topic,
-                topic.last_event_id,
+            # older sqlite versions don't support RETURNING
+            await self.db.execute(
+                query.replace("DO UPDATE SET server=excluded.server", "DO NOTHING")
+                .replace("RETURNING id, server, topic, last_event_id", ""),
+                server,
+                topic,
             )
-            topic.id = cur.lastrowid
-        else:
-            topic.id = await self.db.fetchval(
-                query,
-                topic.server,
-                topic.topic,
-                topic.last_event_id,
-            )
-        return topic
+            return await self.get_topic(server, topic)
+        return Topic.from_row(await self.db.fetchrow(query, server, topic))
 
     async def get_topic(self, server: str, topic: str) -> Topic | None:
         query = """
@@ -147,35 +155,28 @@ class DB:
         """
         return Topic.from_row(await self.db.fetchrow(query, server, topic))
 
-    async def get_subscription(self, topic_id: int, room_id: RoomID) -> Tuple[Subscription | None, Topic | None]:
-        query = """
-        SELECT id, server, topic, last_event_id, topic_id, room_id
-        FROM topics
-        INNER JOIN
-            subscriptions ON topics.id = subscriptions.topic_id AND subscriptions.room_id = $2
-        WHERE topics.id = $1
-        """
-        row = await self.db.fetchrow(query, topic_id, room_id)
-        return (Subscription.from_row(row), Topic.from_row(row))
-
-    async def get_subscriptions(self, topic_id: int) -> List[Subscription]:
+    async def get_subscription(self, topic_id: int, room_id: RoomID) -> Subscription | None:
         query = """
         SELECT topic_id, room_id
         FROM subscriptions
-        WHERE topic_id = $1
+        WHERE topic_id = $1 AND room_id = $2
         """
-        rows = await self.db.fetch(query, topic_id)
-        subscriptions = []
-        for row in rows:
-            subscriptions.append(Subscription.from_row(row))
-        return subscriptions
+        return Subscription.from_row(await self.db.fetchrow(query, topic_id, room_id))
 
-    async def add_subscription(self, topic_id: int, room_id: RoomID) -> None:
+    async def try_add_subscription(self, topic_id: int, room_id: RoomID) -> bool:
         query = """
         INSERT INTO subscriptions (topic_id, room_id)
         VALUES ($1, $2)
+        ON CONFLICT DO NOTHING RETURNING 1
         """
-        await self.db.execute(query, topic_id, room_id)
+        if self.db.scheme == Scheme.SQLITE:
+            cur = await self.db.execute(
+                query.replace("RETURNING 1", ""),
+                topic_id,
+                room_id,
+            )
+            return cur.rowcount > 0
+        return await self.db.fetchval(query, topic_id, room_id) is not None
 
     async def remove_subscription(self, topic_id: int, room_id: RoomID) -> None:
         query = """
@@ -1,10 +1,13 @@
-from types import SimpleNamespace
+from functools import lru_cache
 from typing import List, Tuple
 
-from mautrix.util.logging import TraceLogger
-
 try:
     import emoji
+
+    def emojize(tag: str) -> str:
+        return emoji.emojize(f":{tag}:", language="alias")
+
+    is_emoji = emoji.is_emoji
     EMOJI_FALLBACK = False
 except ImportError:
     # basic list of supported emoji, based on https://docs.ntfy.sh/publish/#tags-emojis
@@ -26,23 +29,32 @@ except ImportError:
         "computer": "💻",
         "white_check_mark": "✅",
     }
-    emoji = SimpleNamespace()
-    emoji.emojize = lambda e, **kwargs: emoji_dict.get(e[1:-1], e)
-    emoji.is_emoji = lambda e: e in emoji_dict.values()
+    emoji_set = frozenset(emoji_dict.values())
+
+    def emojize(tag: str) -> str:
+        return emoji_dict.get(tag, f":{tag}:")
+
+    def is_emoji(string: str) -> bool:
+        return string in emoji_set
+
     EMOJI_FALLBACK = True
 
-WHITE_CHECK_MARK = emoji.emojize(":white_check_mark:", language="alias")
+WHITE_CHECK_MARK = emojize("white_check_mark")
+
+
+@lru_cache(maxsize=1024)
+def _classify(tag: str) -> Tuple[bool, str]:
+    emojized = emojize(tag)
+    return (is_emoji(emojized), emojized)
 
 
-def parse_tags(log: TraceLogger, tags: List[str]) -> Tuple[List[str], List[str]]:
-    if EMOJI_FALLBACK:
-        log.warn("Please install the `emoji` package for full emoji support")
+def parse_tags(tags: List[str]) -> Tuple[List[str], List[str]]:
     emojis = []
     non_emoji_tags = []
 
     for tag in tags:
-        emojized = emoji.emojize(f":{tag}:", language="alias")
-        if emoji.is_emoji(emojized):
+        is_emoji_tag, emojized = _classify(tag)
+        if is_emoji_tag:
             emojis.append(emojized)
         else:
             non_emoji_tags.append(tag)